@@ -3,13 +3,12 @@ import os
 import glob
 import argparse
 
-import pandas as pd
 import numpy as np
 import torch.nn as nn
 
 from PIL import Image
 from scipy.io import loadmat
-from scipy.ndimage import gaussian_filter
+from functools import lru_cache
 from einops import rearrange
 
 import cv2
@@ -229,7 +228,7 @@ def main(args):
                     # cv2.circle(dot_map, point, radius=1, color=color, thickness=-1)
                     dot_map[point[1],point[0],0] = 1
                 mask = 255 - np.prod(circle_map, axis=-1, keepdims=True)**(1/3)
-                dot_map = np.sum(dot_map, axis=-1, keepdims=False).astype(np.float64)
+                dot_map = np.sum(dot_map, axis=-1, keepdims=False).astype(np.float32)
                 density = torch.tensor(dot_map)
 
                 density = density.unsqueeze(0).unsqueeze(0)
@@ -327,10 +326,8 @@ def main(args):
                 
                 image = np.concatenate(np.split(image, 2, axis=1), axis=0) if args.with_density else image
                 Image.fromarray(image, mode='RGB').save(file)
-                density = rearrange(torch.tensor(density), 'h w c -> h (c w)').detach().numpy()
-                file = os.path.join(den_path,str(index)+'-'+str(sub_index+1)+'.csv')
-                density = pd.DataFrame(density.squeeze())
-                density.to_csv(file, header=None, index=False)
+                file = os.path.join(den_path,str(index)+'-'+str(sub_index+1)+'.npy')
+                np.save(file, density.astype(np.float32))
                 # print(file)
 
             
@@ -407,25 +404,23 @@ def get_circle_count(image, normalizer=1, threshold=0, draw=False):
 
 def create_dot_map(locations, image_size):
 
-    density = np.zeros(image_size[:-1])
+    density = np.zeros(image_size[:-1], dtype=np.float32)
+
+    locations = locations[np.all(np.isfinite(locations), axis=1)]
+    locations = locations.astype(np.int64)
+    y = np.clip(locations[:,1], 0, image_size[0]-1)
+    x = np.clip(locations[:,0], 0, image_size[1]-1)
+    np.add.at(density, (y, x), 1.)
 
-    for a,b in locations:
-        x, y = int(a), int(b)
-        try:
-            density[y,x] = 1.
-        except:
-            pass
     return density
 
 
+@lru_cache(maxsize=None)
 def create_density_kernel(kernel_size, sigma):
-    
-    kernel = np.zeros((kernel_size, kernel_size))
-    mid_point = kernel_size//2
-    kernel[mid_point, mid_point] = 1
-    kernel = gaussian_filter(kernel, sigma=sigma)
 
-    return kernel
+    kernel = cv2.getGaussianKernel(kernel_size, sigma).astype(np.float32)
+
+    return kernel @ kernel.T
 
 
 def resize_rescale_info(image, locations, image_size):
@@ -1,19 +1,23 @@
-import torch
 import os
 import glob
 import argparse
 
-import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache, partial
+
 import numpy as np
-import torch.nn as nn
 
+from numpy.lib.stride_tricks import sliding_window_view
 from PIL import Image
 from scipy.io import loadmat
-from scipy.ndimage import gaussian_filter
-from einops import rearrange
 
 import cv2
 
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
 
 def get_arg_parser():
     parser = argparse.ArgumentParser('Prepare image and density datasets', add_help=False)
@@ -78,105 +82,116 @@ def main(args):
     # normalization constants
     normalizer = 0.008
 
-    # crop image parameters
-    image_size = args.image_size
-
-    # device parameter
-    device = 'cpu'
-
     # distribution of crowd count
     crowd_bin = [0,0,0,0]
 
     img_list = sorted(glob.glob(os.path.join(data_dir, mode+'_data', 'images', '*.jpg')))
     print(f"Found {len(img_list)} images to process.")
 
-    sub_list = setup_sub_folders(img_list, output_dir, ndevices=args.ndevices)
+    sub_list = setup_sub_folders(img_list, output_dir, mode, ndevices=args.ndevices)
 
     kernel_list = []
     kernel_list = [create_density_kernel(kernel_size_list[index], sigma_list[index]) for index in range(len(sigma_list))]
     normalizer = [kernel.max() for kernel in kernel_list]
+    kernels = stack_kernels(kernel_list)
 
-    kernel_list = [GaussianKernel(kernel, device) for kernel in kernel_list]
+    # flatten the shards but keep the part assignment so the output
+    # layout stays part_{n}/{mode}; the pool load-balances across images
+    files = [file for img_list in sub_list for file in img_list]
+    devices = [device for device, img_list in enumerate(sub_list) for _ in img_list]
 
-    count = 0
+    worker = partial(process_one, args=args, kernels=kernels,
+                     normalizer=normalizer, output_dir=output_dir)
 
-    for device, img_list in enumerate(sub_list):
-        for file in img_list:
+    count = 0
+    with ProcessPoolExecutor(max_workers=args.ndevices) as executor:
+        for _ in executor.map(worker, files, devices):
             count += 1
             if count % 10 == 0:
-                print(f"Processing image {count}/{len(img_list)}: {file}")
-            # load the images and locations
-            image = Image.open(file).convert('RGB')
-
-            file = file.replace('images', 'ground-truth').replace('IMG', 'GT_IMG').replace('jpg', 'mat')
-            locations = loadmat(file)['image_info'][0][0]['location'][0][0]
-
-            # resize the image and rescale locations
-            if image_size == -1:
-                image = np.asarray(image)
-            else:
-                if mode == 'train' or mode == 'test':
-                    image, locations = resize_rescale_info(image, locations, image_size)
-                else:
-                    image = np.asarray(image)
-            
-            # create dot map
-            density = create_dot_map(locations, image.shape)        
-            density = torch.tensor(density)
-
-            density = density.unsqueeze(0).unsqueeze(0)
-            density_maps = [kernel(density) for kernel in kernel_list]
-            density = torch.stack(density_maps).detach().numpy()
-            density = density.transpose(1,2,0)
-
-            # create image crops
-            if image_size == -1:
-                images, densities = np.expand_dims(image, 0), np.expand_dims(density, 0)
-            else:
-                if mode == 'train' or mode == 'test':
-                    images = create_overlapping_crops(image, image_size, 0.5)
-                    densities = create_overlapping_crops(density, image_size, 0.5)
-                else:
-                    images, densities = create_non_overlapping_crops(image, density, image_size)
-
-            index = os.path.basename(file).split('.')[0].split('_')[-1]
-
-            path = os.path.join(output_dir, f'part_{device+1}', mode)
-            den_path = path.replace(os.path.basename(path), os.path.basename(path)+'_den')
-
-            try:
-                os.makedirs(path, exist_ok=True)
-                os.makedirs(den_path, exist_ok=True)
-                print(f"Created directories: {path}, {den_path}")
-            except FileExistsError:
-                pass
-            
-            for sub_index, (image, density) in enumerate(zip(images, densities)):
-                file = os.path.join(path, str(index)+'-'+str(sub_index+1)+'.jpg')
-                print(f"Saving image crop to {file}")
-                
-                if args.with_density:
-                    req_image = [(density[:,:,index]/normalizer[index]*255.).clip(0,255).astype(np.uint8) for index in range(len(normalizer))]
-                    req_image = torch.tensor(np.asarray(req_image))
-                    req_image = rearrange(req_image, 'c h w -> h (c w)')
-                    req_image = req_image.detach().numpy()
-                    if len(req_image.shape) < 3:
-                        req_image = req_image[:,:,np.newaxis]
-                    req_image = np.repeat(req_image, 3, -1)
-                    image = np.concatenate([image, req_image], axis=1)
-                
-                image = np.concatenate(np.split(image, 2, axis=1), axis=0) if args.with_density else image
-                Image.fromarray(image, mode='RGB').save(file)
-                density = rearrange(torch.tensor(density), 'h w c -> h (c w)').detach().numpy()
-                file = os.path.join(den_path, str(index)+'-'+str(sub_index+1)+'.csv')
-                print(f"Saving density map to {file}")
-                density = pd.DataFrame(density.squeeze())
-                density.to_csv(file, header=None, index=False)
+                print(f"Processed {count}/{len(files)} images")
 
     print(f"Total images processed: {count}")
     print(f"Normalization values: {normalizer}")
 
 
+# per-process background writer so JPEG encodes and density dumps
+# overlap with the rest of the per-image work; process_one drains its
+# own futures before returning, so nothing is left queued at exit
+_writer = None
+
+
+def get_writer():
+    global _writer
+    if _writer is None:
+        _writer = ThreadPoolExecutor(max_workers=2)
+    return _writer
+
+
+def save_image_crop(file, image):
+    if not cv2.imwrite(file, cv2.cvtColor(image, cv2.COLOR_RGB2BGR), [cv2.IMWRITE_JPEG_QUALITY, 95]):
+        raise OSError(f'failed to write {file}')
+
+
+def process_one(file, device, args, kernels, normalizer, output_dir):
+    mode = args.mode
+    image_size = args.image_size
+
+    # load the images and locations
+    image = cv2.cvtColor(cv2.imread(file), cv2.COLOR_BGR2RGB)
+
+    file = file.replace('images', 'ground-truth').replace('IMG', 'GT_IMG').replace('jpg', 'mat')
+    locations = loadmat(file)['image_info'][0][0]['location'][0][0]
+
+    # resize the image and rescale locations
+    if image_size != -1 and (mode == 'train' or mode == 'test'):
+        image, locations = resize_rescale_info(image, locations, image_size)
+
+    # splat the stacked Gaussian patches at each head location instead
+    # of convolving a dense dot map; all kernels go in one pass
+    density = splat(locations, image.shape[:-1], kernels)
+
+    # create image crops
+    if image_size == -1:
+        images, densities = np.expand_dims(image, 0), np.expand_dims(density, 0)
+    else:
+        if mode == 'train' or mode == 'test':
+            images = create_overlapping_crops(image, image_size, 0.5)
+            densities = create_overlapping_crops(density, image_size, 0.5)
+        else:
+            images, densities = create_non_overlapping_crops(image, density, image_size)
+
+    index = os.path.basename(file).split('.')[0].split('_')[-1]
+
+    path = os.path.join(output_dir, f'part_{device+1}', mode)
+    den_path = path.replace(os.path.basename(path), os.path.basename(path)+'_den')
+
+    writer = get_writer()
+    pending = []
+
+    for sub_index, (image, density) in enumerate(zip(images, densities)):
+        file = os.path.join(path, str(index)+'-'+str(sub_index+1)+'.jpg')
+
+        if args.with_density:
+            # scale all channels at once and lay them out side by side
+            # (h w c -> h (c w)) straight from the stored layout
+            req_image = (density/np.asarray(normalizer)*255.).clip(0,255).astype(np.uint8)
+            req_image = req_image.transpose(0,2,1).reshape(req_image.shape[0], -1)
+            # broadcast the grayscale panel to 3 channels as a view; the
+            # concatenate below materializes it only once
+            req_image = np.broadcast_to(req_image[:,:,np.newaxis], req_image.shape+(3,))
+            image = np.concatenate([image, req_image], axis=1)
+
+        image = np.concatenate(np.split(image, 2, axis=1), axis=0) if args.with_density else image
+        pending.append(writer.submit(save_image_crop, file, image))
+        file = os.path.join(den_path, str(index)+'-'+str(sub_index+1)+'.npy')
+        pending.append(writer.submit(np.save, file, density))
+
+    # drain the queued writes so failures surface here instead of
+    # silently leaving an incomplete dataset behind
+    for future in pending:
+        future.result()
+
+
 def get_kernel_and_sigma_list(args):
     kernel_list = [int(item) for item in args.kernel_size.split(' ')]
     sigma_list = [float(item) for item in args.sigma.split(' ')]
@@ -197,49 +212,74 @@ def get_circle_count(image, normalizer=1, threshold=0, draw=False):
     return len(contours)-1
 
 
-def create_dot_map(locations, image_size):
-    density = np.zeros(image_size[:-1])
-    for x,y in locations:
-        x, y = int(x), int(y)
-        density[y,x] = 1.
+def splat_patches(locations, density, kernels, mid_point):
+    for index in range(locations.shape[0]):
+        x, y = locations[index,0], locations[index,1]
+        y0, y1 = max(0, y-mid_point), min(density.shape[0], y+mid_point+1)
+        x0, x1 = max(0, x-mid_point), min(density.shape[1], x+mid_point+1)
+        ky0, kx0 = mid_point-(y-y0), mid_point-(x-x0)
+        density[y0:y1, x0:x1] += kernels[ky0:ky0+(y1-y0), kx0:kx0+(x1-x0)]
+
+
+# compile the stamping loop when numba is available, otherwise keep the
+# pure-numpy version
+if njit is not None:
+    splat_patches = njit(cache=True, fastmath=True)(splat_patches)
+
+
+def splat(locations, shape, kernels):
+    density = np.zeros(shape+(kernels.shape[-1],), dtype=np.float32)
+    # drop NaN/inf annotations and cast once before the stamping loop
+    locations = locations[np.all(np.isfinite(locations), axis=1)]
+    splat_patches(locations.astype(np.int32), density, kernels, kernels.shape[0]//2)
     return density
 
 
+def stack_kernels(kernel_list):
+    # zero-pad every kernel to the largest size so one splat pass can
+    # stamp all of them; padding keeps the kernels centred
+    size = max(kernel.shape[0] for kernel in kernel_list)
+    kernels = np.zeros((size, size, len(kernel_list)), dtype=np.float32)
+    for index, kernel in enumerate(kernel_list):
+        offset = (size-kernel.shape[0])//2
+        kernels[offset:offset+kernel.shape[0], offset:offset+kernel.shape[1], index] = kernel
+    return kernels
+
+
+@lru_cache(maxsize=None)
 def create_density_kernel(kernel_size, sigma):
-    kernel = np.zeros((kernel_size, kernel_size))
-    mid_point = kernel_size//2
-    kernel[mid_point, mid_point] = 1
-    kernel = gaussian_filter(kernel, sigma=sigma)
-    return kernel
+    kernel = cv2.getGaussianKernel(kernel_size, sigma).astype(np.float32)
+    return kernel @ kernel.T
 
 
 def resize_rescale_info(image, locations, image_size):
-    w,h = image.size
+    h,w = image.shape[:2]
     if h < image_size or w < image_size:
         scale = np.ceil(max(image_size/h, image_size/w))
         h, w = int(scale*h), int(scale*w)
-        locations = locations*scale
-    image = image.resize((w,h))
-    return np.asarray(image), locations
+        locations = (locations*scale).astype(np.float32)
+        image = cv2.resize(image, (w,h), interpolation=cv2.INTER_LINEAR)
+    return image, locations
 
 
 def create_non_overlapping_crops(image, density, image_size):
-    h, w = density.shape
-    h, w = (h-1+image_size)//image_size, (w-1+image_size)//image_size
-    h, w = h*image_size, w*image_size
-    pad_density = np.zeros((h,w), dtype=density.dtype)
-    pad_image = np.zeros((h,w,image.shape[-1]), dtype=image.dtype)
-    start_h = (pad_density.shape[0] - density.shape[0])//2
-    end_h = start_h + density.shape[0]
-    start_w = (pad_density.shape[1] - density.shape[1])//2
-    end_w = start_w + density.shape[1]
-    pad_density[start_h:end_h, start_w:end_w] = density
-    pad_image[start_h:end_h, start_w:end_w] = image
-    pad_density = torch.tensor(pad_density)
-    pad_image = torch.tensor(pad_image)
-    pad_density = rearrange(pad_density, '(p1 h) (p2 w) -> (p1 p2) h w', h=image_size, w=image_size).numpy()
-    pad_image = rearrange(pad_image, '(p1 h) (p2 w) c -> (p1 p2) h w c', h=image_size, w=image_size).numpy()
-    return pad_image, pad_density
+    h, w = density.shape[:2]
+    p1, p2 = (h-1+image_size)//image_size, (w-1+image_size)//image_size
+    start_h, start_w = (p1*image_size-h)//2, (p2*image_size-w)//2
+    crop_image = np.zeros((p1*p2, image_size, image_size, image.shape[-1]), dtype=image.dtype)
+    crop_density = np.zeros((p1*p2, image_size, image_size)+density.shape[2:], dtype=density.dtype)
+    # gather each tile straight from the source instead of building a
+    # padded full-size canvas first; only border tiles touch the zero
+    # padding, and the crops come out C-contiguous HWC by construction
+    for index in range(p1*p2):
+        ty, tx = divmod(index, p2)
+        y0, x0 = ty*image_size-start_h, tx*image_size-start_w
+        sy0, sx0 = max(0, y0), max(0, x0)
+        sy1, sx1 = min(h, y0+image_size), min(w, x0+image_size)
+        dy0, dx0 = sy0-y0, sx0-x0
+        crop_image[index, dy0:dy0+(sy1-sy0), dx0:dx0+(sx1-sx0)] = image[sy0:sy1, sx0:sx1]
+        crop_density[index, dy0:dy0+(sy1-sy0), dx0:dx0+(sx1-sx0)] = density[sy0:sy1, sx0:sx1]
+    return crop_image, crop_density
 
 
 def create_overlapping_crops(image, crop_size, overlap):
@@ -267,21 +307,13 @@ def start_points(size, split_size, overlap=0):
 
 
 def arrange_crops(image, x_start, y_start, crop_size):
-    crops = []
-    for i in y_start:
-        for j in x_start:
-            split = image[i:i+crop_size, j:j+crop_size, :]
-            crops.append(split)
-    try:
-        crops = np.stack(crops)
-    except ValueError:
-        print(image.shape)
-        for crop in crops:
-            print(crop.shape)
+    windows = sliding_window_view(image, (crop_size, crop_size, image.shape[-1]))[:,:,0]
+    crops = windows[np.ix_(y_start, x_start)]
+    crops = np.ascontiguousarray(crops.reshape(-1, crop_size, crop_size, image.shape[-1]))
     return crops
 
 
-def setup_sub_folders(img_list, output_dir, ndevices=4):
+def setup_sub_folders(img_list, output_dir, mode, ndevices=4):
     per_device = len(img_list)//ndevices
     sub_list = []
     for device in range(ndevices-1):
@@ -289,24 +321,11 @@ def setup_sub_folders(img_list, output_dir, ndevices=4):
     sub_list.append(img_list[(ndevices-1)*per_device:])
     for device in range(ndevices):
         sub_path = os.path.join(output_dir, f'part_{device+1}')
-        try:
-            os.mkdir(sub_path)
-        except FileExistsError:
-            pass
+        os.makedirs(os.path.join(sub_path, mode), exist_ok=True)
+        os.makedirs(os.path.join(sub_path, mode+'_den'), exist_ok=True)
     return sub_list
 
 
-class GaussianKernel(nn.Module):
-    def __init__(self, kernel_weights, device):
-        super().__init__()
-        self.kernel = nn.Conv2d(1,1,kernel_weights.shape, bias=False, padding=kernel_weights.shape[0]//2)
-        kernel_weights = torch.tensor(kernel_weights).unsqueeze(0).unsqueeze(0)
-        with torch.no_grad():
-            self.kernel.weight = nn.Parameter(kernel_weights)
-    def forward(self, density):
-        return self.kernel(density).squeeze()
-
-
 if __name__=='__main__':
     parser = argparse.ArgumentParser('Prepare image and density dataset', parents=[get_arg_parser()])
     args = parser.parse_args()
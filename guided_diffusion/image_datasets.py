@@ -1,6 +1,5 @@
 import math
 import random
-import pandas as pd
 import cv2
 import os
 
@@ -119,25 +118,23 @@ class ImageDataset(Dataset):
         image = np.array(image.convert('RGB'))
         image = image.astype(np.float32) / 127.5 - 1        
 
-        # get the density map for the image
-        path = path.replace('train','train_den').replace('jpg','csv')
-        path = path.replace('test','test_den').replace('jpg','csv')
+        # get the density map for the image, stored as a (h,w,c) array
+        path = path.replace('train','train_den').replace('jpg','npy')
+        path = path.replace('test','test_den').replace('jpg','npy')
 
-        csv_density = np.asarray(pd.read_csv(path, header=None).values)
-        count =  np.sum(csv_density)
+        density = np.load(path)
+        count =  np.sum(density)
         count = np.ceil(count) if count > 1 else count
-        csv_density = np.stack(np.split(csv_density, len(self.normalizer), -1))
-        csv_density = np.asarray([m/n for m,n in zip(csv_density, self.normalizer)])
-        csv_density = csv_density.transpose(1,2,0)
+        density = density / np.asarray(self.normalizer)
 
-        csv_density = csv_density.clip(0,1)
-        csv_density = 2*csv_density - 1
-        csv_density = csv_density.astype(np.float32)
+        density = density.clip(0,1)
+        density = 2*density - 1
+        density = density.astype(np.float32)
 
         out_dict = {"count": count.astype(np.float32)}
         if self.local_classes is not None:
             out_dict["y"] = np.array(self.local_classes[idx], dtype=np.int64)
-        return np.transpose(np.concatenate([csv_density, image], axis=-1), [2, 0, 1]), out_dict
+        return np.transpose(np.concatenate([density, image], axis=-1), [2, 0, 1]), out_dict
 
 
 def save_images(image, density, path):
@@ -9,7 +9,6 @@ import glob
 import cv2
 
 from PIL import Image
-import pandas as pd
 
 import blobfile as bf
 import numpy as np
@@ -395,7 +394,7 @@ def load_data_for_worker(base_samples, batch_size, normalizer, pred_channels, fi
     den_list = []
     for _ in img_list:
         den_path =  _.replace('test','test_den')
-        den_path = den_path.replace('.jpg','.csv')
+        den_path = den_path.replace('.jpg','.npy')
         den_list.append(den_path)
 
     image_arr, den_arr = [], []
@@ -403,11 +402,9 @@ def load_data_for_worker(base_samples, batch_size, normalizer, pred_channels, fi
         image = Image.open(file)
         image_arr.append(np.asarray(image))
 
-        file = file.replace('test','test_den').replace('jpg','csv')
-        image = np.asarray(pd.read_csv(file, header=None).values)
-        image = np.stack(np.split(image, len(normalizer), -1))
-        image = np.asarray([m/n for m,n in zip(image, normalizer)])
-        image = image.transpose(1,2,0).clip(0,1)
+        file = file.replace('test','test_den').replace('jpg','npy')
+        image = np.load(file)
+        image = (image / np.asarray(normalizer)).clip(0,1)
         den_arr.append(image)
 
     rank = dist.get_rank()
@@ -7,7 +7,6 @@ import glob
 import os
 from PIL import Image
 import numpy as np
-import pandas as pd
 import torch as th
 
 from time import time, sleep
@@ -116,7 +115,7 @@ def load_data_for_worker(args):
     den_list = []
     for _ in img_list:
         den_path =  _.replace('test','test_den')
-        den_path = den_path.replace('.jpg','.csv')
+        den_path = den_path.replace('.jpg','.npy')
         den_list.append(den_path)
     # print(f'list prepared: {(time()-start) :.4f}s.')
 
@@ -128,14 +127,12 @@ def load_data_for_worker(args):
         # print(f'image read: {(time()-start) :.4f}s.')
 
         # start = time()
-        file = file.replace('test','test_den').replace('jpg','csv')
-        image = np.asarray(pd.read_csv(file, header=None).values)
+        file = file.replace('test','test_den').replace('jpg','npy')
+        image = np.load(file)
         # print(f'density read: {(time()-start) :.4f}s.')
 
         # start = time()
-        image = np.stack(np.split(image, len(normalizer), -1))
-        image = np.asarray([m/n for m,n in zip(image, normalizer)])
-        image = image.transpose(1,2,0).clip(0,1)
+        image = (image / np.asarray(normalizer)).clip(0,1)
         den_arr.append(image)
         # print(f'density prepared: {(time()-start) :.4f}s.')
 